@@ -1,18 +1,30 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify
+from flask import Flask, render_template, redirect, url_for, flash, session, g
+from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, func, inspect, or_, select, text, update
+from sqlalchemy.orm import load_only
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, BooleanField, IntegerField, ValidationError
 from wtforms.validators import DataRequired, NumberRange, Regexp
 from config import Config
+import fcntl
+import functools
 import logging
 import os
 import pyotp
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import secrets
 import json
+import orjson
+import queue
 import socket
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 import subprocess
 from cryptography.hazmat.primitives.asymmetric import x25519
@@ -20,6 +32,9 @@ from cryptography.hazmat.primitives import serialization
 import base64
 import speedtest
 import ping3
+import redis
+from apscheduler.schedulers.background import BackgroundScheduler
+from cachetools import TTLCache, cached
 
 # Configure logging
 logging.basicConfig(
@@ -31,6 +46,12 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Keep session data in Redis when configured so only a short id travels in the cookie
+if app.config['REDIS_URL']:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(app.config['REDIS_URL'])
+    Session(app)
+
 # Initialize SQLAlchemy
 db = SQLAlchemy(app)
 
@@ -43,9 +64,22 @@ class User(db.Model):
     last_reset = db.Column(db.DateTime, default=datetime.utcnow)
     sharing_active = db.Column(db.Boolean, default=False)
     connection_id = db.Column(db.String(36), nullable=True)  # UUID for active connection
+    otp_secret = db.Column(db.String(32), default=pyotp.random_base32)  # base32 TOTP secret
+
+    # Never lazy-loaded: a stray access in a loop would be an N+1, so it raises
+    # instead; eager-load with selectinload where the relationship is needed
+    connections = db.relationship('Connection', back_populates='sharer', lazy='raise_on_sql')
+
+    __table_args__ = (
+        # Available sharer scans; the partial index holds only sharers that are sharing
+        db.Index('ix_active_sharers', shared_data, limit_gb,
+                 postgresql_where=and_(role == 'sharer', sharing_active == True),
+                 sqlite_where=and_(role == 'sharer', sharing_active == True)),
+        db.Index('ix_user_last_reset', 'last_reset'),  # daily reset
+    )
 
 class Connection(db.Model):
-    id = db.Column(db.String(36), primary_key=True)  # UUID
+    id = db.Column(db.String(36), primary_key=True, default=lambda: uuid.uuid4().hex)  # UUID
     sharer_phone = db.Column(db.String(10), db.ForeignKey('user.phone'))
     client_phone = db.Column(db.String(10), nullable=True)  # Can be null if no client connected
     fly_instance = db.Column(db.String(50), nullable=False)  # fly.io instance ID
@@ -60,11 +94,63 @@ class Connection(db.Model):
     password = db.Column(db.String(50))  # SOCKS5 password
 
     # Relationship to sharer
-    sharer = db.relationship('User', backref='connections')
+    sharer = db.relationship('User', back_populates='connections', lazy='raise_on_sql')
+
+    __table_args__ = (
+        db.Index('ix_conn_sharer_status', 'sharer_phone', 'status'),  # a sharer's active connections
+        db.Index('ix_conn_client', 'client_phone'),
+        db.Index('ix_conn_status_last_active', 'status', 'last_active'),  # stale connection sweeps
+    )
+
+# Sharers with spare capacity, built once so the compiled statement is reused
+AVAILABLE_SHARERS = select(User).where(
+    User.role == 'sharer',
+    User.sharing_active == True,
+    User.shared_data < User.limit_gb
+)
+
+# Only the columns /api/network/available returns, with the signal tier computed in SQL
+_available_gb = User.limit_gb - User.shared_data
+AVAILABLE_NETWORKS = select(
+    User.phone,
+    _available_gb,
+    case((_available_gb > 2, 'good'), else_='fair')
+).where(
+    User.role == 'sharer',
+    User.sharing_active == True,
+    User.shared_data < User.limit_gb
+)
+
+def get_active_connections(sharer_phone, *columns):
+    """Return a sharer's active connections, loading only `columns` if given"""
+    stmt = select(Connection).where(
+        Connection.sharer_phone == sharer_phone,
+        Connection.status == 'active'
+    )
+    if columns:
+        stmt = stmt.options(load_only(*columns))
+    return db.session.execute(stmt).scalars().all()
+
+def find_least_used_sharer():
+    """Return the available sharer with the most spare capacity, or None"""
+    # Not locked: a sharer serves many clients, and switch_connection locks
+    # the rows it changes
+    return db.session.execute(
+        AVAILABLE_SHARERS
+        .order_by((User.shared_data / User.limit_gb).asc())
+        .limit(1)
+    ).scalar_one_or_none()
 
 # ======= Forms =======
+PHONE_RE = re.compile(r'^\d{10}$')
+
+class PhoneRegexp(Regexp):
+    """10-digit phone number check sharing one compiled pattern"""
+    def __init__(self):
+        super().__init__(PHONE_RE, message="Phone number must be 10 digits")
+
 class LoginForm(FlaskForm):
-    phone = StringField('Phone Number', validators=[DataRequired(), Regexp(r'^\d{10}$', message="Phone number must be 10 digits")])
+    phone = StringField('Phone Number', validators=[DataRequired(), PhoneRegexp()])
     submit = SubmitField('Send OTP')
 
 class OTPForm(FlaskForm):
@@ -72,7 +158,7 @@ class OTPForm(FlaskForm):
     submit = SubmitField('Verify OTP')
 
 class SignupForm(FlaskForm):
-    phone = StringField('Phone Number', validators=[DataRequired(), Regexp(r'^\d{10}$', message="Phone number must be 10 digits")])
+    phone = StringField('Phone Number', validators=[DataRequired(), PhoneRegexp()])
     role = StringField('Role (sharer/client)', validators=[DataRequired()])
     submit = SubmitField('Create Account')
 
@@ -81,7 +167,8 @@ class SignupForm(FlaskForm):
             raise ValidationError("Role must be 'sharer' or 'client'.")
 
     def validate_phone(form, field):
-        if User.query.get(field.data):
+        # Existence check on the primary key only, no User row is loaded
+        if db.session.query(User.phone).filter_by(phone=field.data).scalar():
             raise ValidationError("Phone number already registered.")
 
 class SharerForm(FlaskForm):
@@ -94,75 +181,136 @@ class ClientForm(FlaskForm):
     disconnect = SubmitField('Disconnect')
 
 # ======= Utils =======
+def ojson(obj, status=200):
+    """JSON response serialized with orjson; naive datetimes are emitted as UTC with a Z suffix"""
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z),
+                              status=status, mimetype='application/json')
+
 def login_required(f):
+    @functools.wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'phone' not in session:
+        if not session.get('phone'):
             flash('Please log in first', 'warning')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
-    decorated_function.__name__ = f.__name__
     return decorated_function
 
-def measure_connection_quality(connection_id):
-    """Ping test and speed measurement"""
-    conn = Connection.query.get(connection_id)
-    if conn:
-        try:
-            # Simulate measurement - replace with real tests
-            conn.latency = random.uniform(10, 100)
-            conn.current_speed = random.uniform(5, 50)
-            conn.last_active = datetime.utcnow()
-            db.session.commit()
-        except Exception as e:
-            logger.error(f"Measurement failed: {str(e)}")
+def get_user(phone):
+    """Look up a user by phone, cached on g for the rest of the request"""
+    users = g.setdefault('_users', {})
+    if phone not in users:
+        users[phone] = db.session.get(User, phone)
+    return users[phone]
+
+# One entry per user now that secrets are stored per account
+@functools.lru_cache(maxsize=4096)
+def get_totp(secret):
+    """Return a cached TOTP object for a base32 secret"""
+    return pyotp.TOTP(secret)
 
 def reset_daily_usage():
     """Reset daily data usage for all users if last_reset was yesterday"""
     with app.app_context():
-        today = datetime.utcnow().date()
-        users = User.query.filter(User.last_reset < today).all()
-        for user in users:
-            user.shared_data = 0.0
-            user.last_reset = datetime.utcnow()
+        now = datetime.utcnow()
+        # Compare against midnight as a datetime so the last_reset index is usable
+        midnight = datetime.combine(now.date(), datetime.min.time())
+        # Single UPDATE ... WHERE last_reset < midnight instead of one per user
+        result = db.session.execute(
+            update(User)
+            .where(User.last_reset < midnight)
+            .values(shared_data=0.0, last_reset=now)
+            .execution_options(synchronize_session=False)
+        )
         db.session.commit()
-        logger.info(f"Reset daily usage for {len(users)} users")
+        logger.info(f"Reset daily usage for {result.rowcount} users")
+
+# WireGuard server details baked into every client config
+SERVER_PUBLIC_KEY = os.getenv('WG_SERVER_PUBLIC_KEY', '')
+SERVER_ENDPOINT = os.getenv('WG_SERVER_ENDPOINT', 'netshare.fly.dev')
+
+# Only the private key and address vary per user, so the rest is bound once
+_WG_TEMPLATE = (
+    "[Interface]\n"
+    "PrivateKey = {private_key}\n"
+    "Address = 10.0.0.{host}/24\n"
+    "ListenPort = 51820\n"
+    "\n"
+    "[Peer]\n"
+    "PublicKey = " + SERVER_PUBLIC_KEY + "\n"
+    "AllowedIPs = 0.0.0.0/0\n"
+    "Endpoint = " + SERVER_ENDPOINT + ":51820\n"
+    "PersistentKeepalive = 25\n"
+)
 
-def generate_wireguard_config(user_id):
-    """Generate complete WireGuard configuration including keys"""
-    # Generate private key
+# Keypairs are generated ahead of time so tunnel creation doesn't pay for the X25519 scalar mult
+_wg_keys = queue.Queue(maxsize=32)
+_wg_keys_lock = threading.Lock()
+_wg_keys_thread = None
+
+_b64encode = base64.b64encode
+
+def generate_wireguard_keypair():
+    """Generate a base64 encoded (private_key, public_key) pair"""
     private_key = x25519.X25519PrivateKey.generate()
     private_bytes = private_key.private_bytes(
         encoding=serialization.Encoding.Raw,
         format=serialization.PrivateFormat.Raw,
         encryption_algorithm=serialization.NoEncryption()
     )
-    private_key_b64 = base64.b64encode(private_bytes).decode('utf-8')
-
-    # Generate public key
-    public_key = private_key.public_key()
-    public_bytes = public_key.public_bytes(
+    public_bytes = private_key.public_key().public_bytes(
         encoding=serialization.Encoding.Raw,
         format=serialization.PublicFormat.Raw
     )
-    public_key_b64 = base64.b64encode(public_bytes).decode('utf-8')
+    return _b64encode(private_bytes).decode('ascii'), _b64encode(public_bytes).decode('ascii')
+
+def _fill_wireguard_keys():
+    """Keep the keypair queue topped up; put() blocks while the queue is full"""
+    while True:
+        _wg_keys.put(generate_wireguard_keypair())
+
+def get_wireguard_keypair():
+    """Pop a pre-generated keypair, generating inline if the pool is empty"""
+    global _wg_keys_thread
+    with _wg_keys_lock:
+        if _wg_keys_thread is None:
+            _wg_keys_thread = threading.Thread(target=_fill_wireguard_keys, daemon=True)
+            _wg_keys_thread.start()
+    try:
+        return _wg_keys.get_nowait()
+    except queue.Empty:
+        return generate_wireguard_keypair()
+
+def generate_wireguard_config(user_id):
+    """Generate complete WireGuard configuration including keys"""
+    private_key_b64, public_key_b64 = get_wireguard_keypair()
 
     return {
         'private_key': private_key_b64,
         'public_key': public_key_b64,
-        'config': f"""[Interface]
-PrivateKey = {private_key_b64}
-Address = 10.0.0.{user_id % 254 + 1}/24
-ListenPort = 51820
-
-[Peer]
-PublicKey = {SERVER_PUBLIC_KEY}
-AllowedIPs = 0.0.0.0/0
-Endpoint = {SERVER_ENDPOINT}:51820
-PersistentKeepalive = 25
-"""
+        'config': _WG_TEMPLATE.format_map({
+            'private_key': private_key_b64,
+            'host': int(user_id) % 254 + 1
+        })
     }
 
 # Fly.io integration utilities
+FLY_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+
+# One long-lived session so fly.io calls reuse pooled keep-alive connections
+_FLY_SESSION = requests.Session()
+_FLY_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+))
+# Batched fly.io calls fan out over the session's pool
+_fly_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fly')
+
+def _log_fly_exception(future):
+    """Done-callback for background fly.io calls, whose results nobody waits on"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background fly.io call failed: {future.exception()}")
+
 class FlyNetworkManager:
     BASE_URL = os.getenv('FLY_API_URL', 'https://api.fly.io/v1')
     API_KEY = os.getenv('FLY_API_KEY', '')
@@ -183,9 +331,10 @@ class FlyNetworkManager:
             wg_config = generate_wireguard_config(user_id)
 
             # Deploy to fly.io
-            response = requests.post(
+            response = _FLY_SESSION.post(
                 f"{cls.BASE_URL}/apps/netshare-tunnels/machines",
                 headers=cls.get_headers(),
+                timeout=FLY_TIMEOUT,
                 json={
                     "name": f"tunnel-{user_id}",
                     "config": {
@@ -208,101 +357,112 @@ class FlyNetworkManager:
             logger.error(f"Tunnel creation failed: {str(e)}")
             return {'success': False, 'error': str(e)}
 
-        @classmethod
-        def terminate_tunnel(cls, instance_id):
-            """Terminate a fly.io tunnel instance"""
-            try:
-                # This would call the fly.io API to destroy the instance
-                logger.info(f"Terminating fly.io tunnel: {instance_id}")
-                return {'success': True}
-            except Exception as e:
-                logger.error(f"Error terminating fly.io tunnel: {str(e)}")
-                return {'success': False, 'error': str(e)}
-
-        @classmethod
-        def get_active_tunnels(cls):
-            """Get list of active tunnels"""
-            # In a real implementation, this would query the fly.io API
-            try:
-                active_tunnels = Connection.query.filter_by(status='active').all()
-                return {
-                    'success': True,
-                    'tunnels': [
-                        {
-                            'instance_id': conn.fly_instance,
-                            'sharer_id': conn.sharer_phone,
-                            'client_id': conn.client_phone,
-                            'last_active': conn.last_active.isoformat(),
-                            'bandwidth_used': conn.bandwidth_used
-                        }
-                        for conn in active_tunnels
-                    ]
-                }
-            except Exception as e:
-                logger.error(f"Error fetching active tunnels: {str(e)}")
-                return {'success': False, 'error': str(e)}
+    @classmethod
+    def terminate_tunnel(cls, instance_id):
+        """Terminate a fly.io tunnel instance"""
+        try:
+            # This would call the fly.io API to destroy the instance
+            logger.info(f"Terminating fly.io tunnel: {instance_id}")
+            return {'success': True}
+        except Exception as e:
+            logger.error(f"Error terminating fly.io tunnel: {str(e)}")
+            return {'success': False, 'error': str(e)}
 
-# Background task to monitor network stability and switch connections if needed
-def monitor_connections():
-    """Monitor active connections and switch to more stable ones if needed"""
-    while True:
+    @classmethod
+    def terminate_tunnels_async(cls, instance_ids):
+        """Queue tunnel terminations and return their futures without waiting"""
+        # fly.io has no bulk delete, so the calls share the pooled session instead
+        futures = [_fly_executor.submit(cls.terminate_tunnel, instance_id) for instance_id in instance_ids]
+        for future in futures:
+            future.add_done_callback(_log_fly_exception)
+        return futures
+
+    @classmethod
+    def get_active_tunnels(cls):
+        """Get list of active tunnels"""
+        # In a real implementation, this would query the fly.io API
         try:
-            with app.app_context():
-                # Get all active client connections
-                clients = User.query.filter_by(role='client').all()
-                for client in clients:
-                    # If client has a connection_id, check its stability
-                    if client.connection_id:
-                        connection = Connection.query.get(client.connection_id)
-                        if connection:
-                            # Check if connection is still active and stable
-                            # In a real implementation, this would involve ping tests, bandwidth checks, etc.
-                            if connection.status != 'active' or (datetime.utcnow() - connection.last_active).total_seconds() > 300:
-                                # Connection unstable, find a better one
-                                logger.info(f"Connection {connection.id} unstable for client {client.phone}, finding alternative")
-
-                                # Find available sharers with capacity
-                                available_sharers = User.query.filter_by(
-                                    role='sharer',
-                                    sharing_active=True
-                                ).filter(
-                                    User.shared_data < User.limit_gb
-                                ).all()
-
-                                if available_sharers:
-                                    # Sort by least used capacity
-                                    available_sharers.sort(key=lambda x: x.shared_data / x.limit_gb)
-                                    best_sharer = available_sharers[0]
-
-                                    # Create new connection
-                                    switch_connection(client.phone, best_sharer.phone)
-                                    logger.info(f"Switched client {client.phone} to sharer {best_sharer.phone}")
+            # Only the five columns the payload needs, not full Connection rows
+            active_tunnels = db.session.query(
+                Connection.fly_instance,
+                Connection.sharer_phone,
+                Connection.client_phone,
+                Connection.last_active,
+                Connection.bandwidth_used
+            ).filter(Connection.status == 'active').all()
+            return {
+                'success': True,
+                'tunnels': [
+                    {
+                        'instance_id': conn.fly_instance,
+                        'sharer_id': conn.sharer_phone,
+                        'client_id': conn.client_phone,
+                        'last_active': conn.last_active,  # serialized by ojson
+                        'bandwidth_used': conn.bandwidth_used
+                    }
+                    for conn in active_tunnels
+                ]
+            }
         except Exception as e:
-            logger.error(f"Error in connection monitor: {str(e)}")
+            logger.error(f"Error fetching active tunnels: {str(e)}")
+            return {'success': False, 'error': str(e)}
 
-        # Sleep for 1 minute before next check
-        time.sleep(60)
+# Background task to monitor network stability and switch connections if needed
+def monitor_connections_once():
+    """Single monitoring pass: switch clients off unstable connections"""
+    try:
+        with app.app_context():
+            # Only clients whose connection is inactive or quiet for 5 minutes
+            # In a real implementation, this would involve ping tests, bandwidth checks, etc.
+            stale_before = datetime.utcnow() - timedelta(seconds=300)
+            unstable = db.session.query(User, Connection).join(
+                Connection, User.connection_id == Connection.id
+            ).filter(
+                User.role == 'client',
+                or_(Connection.status != 'active', Connection.last_active < stale_before)
+            ).all()
+
+            for client, connection in unstable:
+                # Connection unstable, find a better one
+                logger.info(f"Connection {connection.id} unstable for client {client.phone}, finding alternative")
+
+                best_sharer = find_least_used_sharer()
+                if best_sharer:
+                    # Create new connection
+                    switch_connection(client.phone, best_sharer.phone)
+                    logger.info(f"Switched client {client.phone} to sharer {best_sharer.phone}")
+    except Exception as e:
+        logger.error(f"Error in connection monitor: {str(e)}")
 
 def switch_connection(client_phone, sharer_phone):
     """Switch a client's connection to a new sharer"""
-    client = User.query.get(client_phone)
-    sharer = User.query.get(sharer_phone)
+    # Lock both users until the commit so concurrent switches for the same
+    # client or sharer can't each create a tunnel; phone order avoids deadlocks
+    users = {
+        user.phone: user
+        for user in db.session.execute(
+            select(User)
+            .where(User.phone.in_([client_phone, sharer_phone]))
+            .order_by(User.phone)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        ).scalars()
+    }
+    client = users.get(client_phone)
+    sharer = users.get(sharer_phone)
 
     if not client or not sharer:
         return False
 
     # If client has existing connection, update it
     if client.connection_id:
-        old_connection = Connection.query.get(client.connection_id)
+        old_connection = db.session.get(Connection, client.connection_id)
         if old_connection:
             old_connection.status = 'terminated'
             old_connection.client_phone = None
 
     # Check if sharer has an active connection
-    sharer_connections = Connection.query.filter_by(
-        sharer_phone=sharer.phone,
-        status='active'
-    ).all()
+    sharer_connections = get_active_connections(sharer.phone)
 
     if not sharer_connections:
         # Create new tunnel for sharer
@@ -313,13 +473,13 @@ def switch_connection(client_phone, sharer_phone):
 
         # Create new connection record
         new_connection = Connection(
-            id=str(uuid.uuid4()),
             sharer_phone=sharer.phone,
             client_phone=client.phone,
             fly_instance=tunnel_info['instance_id'],
             status='active'
         )
         db.session.add(new_connection)
+        db.session.flush()  # assigns the default id used below
     else:
         # Use existing sharer connection
         new_connection = sharer_connections[0]
@@ -331,69 +491,111 @@ def switch_connection(client_phone, sharer_phone):
     db.session.commit()
     return True
 
-def measure_connection_quality(connection_id):
-    """Actual network quality measurement"""
-    conn = Connection.query.get(connection_id)
-    if conn:
-        try:
-            # Measure latency
-            latency = ping3.ping(conn.fly_instance + '.fly.dev', unit='ms')
-
-            # Measure download speed
+# Speedtest server discovery takes seconds, so one configured client is shared
+SPEEDTEST_TTL = 300  # seconds before re-discovering speedtest servers
+PING_TIMEOUT = 1.0  # seconds before a single ping gives up
+PROBE_WORKERS = 8
+_speedtest_lock = threading.Lock()
+_speedtest = None
+_speedtest_expires = 0.0
+_probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='probe')
+
+def get_speedtest():
+    """Return a shared Speedtest client, re-discovering servers once per TTL"""
+    global _speedtest, _speedtest_expires
+    with _speedtest_lock:
+        if _speedtest is None or time.monotonic() >= _speedtest_expires:
             st = speedtest.Speedtest()
-            st.download()
-            download_speed = st.results.download / 1_000_000  # Convert to Mbps
-
-            conn.latency = latency if latency else 100  # Default if ping fails
-            conn.current_speed = download_speed
-            conn.last_active = datetime.utcnow()
-            db.session.commit()
+            st.get_servers()
+            st.get_best_server()
+            _speedtest = st
+            _speedtest_expires = time.monotonic() + SPEEDTEST_TTL
+        return _speedtest
+
+def measure_download_speed():
+    """Run one speedtest download and return the speed in Mbps"""
+    st = get_speedtest()
+    with _speedtest_lock:
+        st.download()
+        return st.results.download / 1_000_000  # Convert to Mbps
+
+def probe_latency(fly_instance):
+    """Ping a tunnel instance and return the latency in ms without touching the DB"""
+    latency = ping3.ping(fly_instance + '.fly.dev', timeout=PING_TIMEOUT, unit='ms')
+    return latency if latency else 100  # Default if ping fails
+
+def probe_connections(connections):
+    """Ping connections concurrently, returning {connection_id: latency}"""
+    futures = {_probe_executor.submit(probe_latency, conn.fly_instance): conn.id
+               for conn in connections}
+    # Enough time for every ping to run out its timeout, PROBE_WORKERS at a time
+    rounds = -(-len(futures) // PROBE_WORKERS)
+    done, not_done = wait(futures, timeout=rounds * PING_TIMEOUT + 1)
+
+    # Pings still queued would otherwise pile up behind the next round
+    for future in not_done:
+        future.cancel()
+
+    measurements = {}
+    for future in done:
+        try:
+            measurements[futures[future]] = future.result()
         except Exception as e:
             logger.error(f"Measurement failed: {str(e)}")
-            conn.latency = 100  # Fallback values
-            conn.current_speed = 5
-            db.session.commit()
+    return measurements
 
-def find_optimal_sharer(client):
-    """Find best sharer based on multiple factors"""
-    available_sharers = User.query.filter_by(
-        role='sharer',
-        sharing_active=True
-    ).filter(
-        User.shared_data < User.limit_gb
-    ).all()
-
-    if not available_sharers:
-        return None
-
-    # Score each sharer based on multiple factors
-    scored_sharers = []
-    for sharer in available_sharers:
-        connections = sharer.connections
+def refresh_connection_metrics():
+    """Probe all active connections and store the results in one commit"""
+    with app.app_context():
+        connections = db.session.execute(
+            select(Connection).where(Connection.status == 'active')
+        ).scalars().all()
         if not connections:
-            continue
-
-        # Get latest connection metrics
-        connection = connections[0]
-        measure_connection_quality(connection.id)
+            return
 
-        # Calculate score (higher is better)
-        speed_score = connection.current_speed / 50  # Normalize to 0-1 range
-        latency_score = 1 - (min(connection.latency, 300) / 300)  # Normalize 0-300ms to 1-0
-        capacity_score = 1 - (sharer.shared_data / sharer.limit_gb)
-
-        total_score = 0.5*speed_score + 0.3*latency_score + 0.2*capacity_score
-        scored_sharers.append((total_score, sharer))
+        # The download test measures this host's link, not any one tunnel, so
+        # it runs once per round and every connection's current_speed gets the
+        # same host-wide figure; only latency is measured per connection
+        try:
+            download_speed = measure_download_speed()
+        except Exception as e:
+            logger.error(f"Speed measurement failed: {str(e)}")
+            download_speed = None
+
+        measurements = probe_connections(connections)
+        now = datetime.utcnow()
+        for conn in connections:
+            if conn.id in measurements:
+                conn.latency = measurements[conn.id]
+                if download_speed is not None:
+                    conn.current_speed = download_speed
+                conn.last_active = now
+        db.session.commit()
+        logger.info(f"Refreshed metrics for {len(measurements)}/{len(connections)} connections")
 
-    if not scored_sharers:
-        return None
+def find_optimal_sharer(client):
+    """Find best sharer based on multiple factors"""
+    # Metrics are kept fresh by refresh_connection_metrics, so scoring is a
+    # single query; missing metrics fall back to the old measurement defaults
+    speed = func.coalesce(Connection.current_speed, 5)
+    latency = func.coalesce(Connection.latency, 100)
+    speed_score = speed / 50  # Normalize to 0-1 range
+    latency_score = 1 - case((latency > 300, 300), else_=latency) / 300  # Normalize 0-300ms to 1-0
+    capacity_score = 1 - User.shared_data / User.limit_gb
+    total_score = 0.5*speed_score + 0.3*latency_score + 0.2*capacity_score
 
     # Return sharer with highest score
-    return max(scored_sharers, key=lambda x: x[0])[1]
+    return db.session.execute(
+        AVAILABLE_SHARERS
+        .join(Connection, Connection.sharer_phone == User.phone)
+        .where(Connection.status == 'active')
+        .order_by(total_score.desc())
+        .limit(1)
+    ).scalars().first()
 
 def get_proxy_config(connection_id):
     """Generate proxy configuration for clients"""
-    conn = Connection.query.get(connection_id)
+    conn = db.session.get(Connection, connection_id)
     if not conn:
         return None
 
@@ -402,8 +604,8 @@ def get_proxy_config(connection_id):
         'host': f"{conn.fly_instance}.fly.dev",
         'port': 1080,  # Standard SOCKS port
         'username': 'netshare_user',
-        'password': str(uuid.uuid4()),  # Temporary credential
-        'expires': (datetime.utcnow() + timedelta(hours=1)).isoformat()
+        'password': secrets.token_urlsafe(18),  # Temporary credential
+        'expires': datetime.utcnow() + timedelta(hours=1)
     }
 # ======= Routes =======
 @app.route('/signup', methods=['GET', 'POST'])
@@ -428,20 +630,14 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         phone = form.phone.data
-        user = User.query.get(phone)
+        user = get_user(phone)
         if user:
-            secret = session.get('otp_secret')
-            if not secret:
-                secret = pyotp.random_base32()
-                session['otp_secret'] = secret
-            else:
-                secret = session['otp_secret']
+            # Accounts created before the column existed get their secret on first login
+            if not user.otp_secret:
+                user.otp_secret = pyotp.random_base32()
+                db.session.commit()
             session['phone_tmp'] = phone
-            totp = pyotp.TOTP(secret)
-            otp = totp.now()
-
-            # Store OTP in session to display on verification page
-            session['current_otp'] = otp
+            otp = get_totp(user.otp_secret).now()
 
             # Log OTP for development purposes
             logger.info(f"OTP for {phone}: {otp}")
@@ -454,19 +650,22 @@ def login():
 @app.route('/verify', methods=['GET', 'POST'])
 def verify_otp():
     form = OTPForm()
-    otp_to_display = session.get('current_otp')
     phone = session.get('phone_tmp')
+    user = get_user(phone) if phone else None
+    secret = user.otp_secret if user else None
+
+    # The OTP is derived from the secret when needed rather than kept in the cookie;
+    # it is only shown on the page in debug or when SHOW_OTP is set
+    otp_to_display = None
+    if secret and (app.debug or app.config.get('SHOW_OTP')):
+        otp_to_display = get_totp(secret).now()
 
     if form.validate_on_submit():
         otp = form.otp.data
-        secret = session.get('otp_secret')
-        totp = pyotp.TOTP(secret)
 
-        if totp.verify(otp, valid_window=1):  # allows +/- 30 seconds (1 window)
+        if secret and get_totp(secret).verify(otp, valid_window=1):  # allows +/- 30 seconds (1 window)
             session['phone'] = phone  # Set the phone in the session
-            session.pop('otp_secret', None)
             session.pop('phone_tmp', None)
-            session.pop('current_otp', None)  # Remove displayed OTP from session
             flash('OTP verified. Logged in.', 'success')
             logger.info(f"OTP verified for {phone}. Redirecting to dashboard.")
             return redirect(url_for('dashboard'))
@@ -476,11 +675,16 @@ def verify_otp():
 
     return render_template('verify.html', form=form, otp_to_display=otp_to_display, phone=phone)
 
-@app.route('/dashboard', methods=['GET', 'POST'])
+@app.route('/dashboard')
 @login_required
 def dashboard():
     phone = session.get('phone')
-    user = User.query.get(phone)
+
+    # Load the user and their current connection (if any) in one round trip
+    row = db.session.query(User, Connection).outerjoin(
+        Connection, Connection.id == User.connection_id
+    ).filter(User.phone == phone).one_or_none()
+    user, active_connection = row if row else (None, None)
 
     if not user:
         flash('User not found in database.', 'danger')
@@ -490,60 +694,20 @@ def dashboard():
 
     if role == 'sharer':
         form = SharerForm(limit_gb=user.limit_gb, sharing=user.sharing_active)
-        if form.validate_on_submit():
-            # Update user settings
-            user.limit_gb = form.limit_gb.data
-
-            # Handle sharing toggle
-            if form.sharing.data != user.sharing_active:
-                if form.sharing.data:
-                    # Start sharing
-                    tunnel_info = FlyNetworkManager.create_tunnel(user.phone)
-                    if tunnel_info['success']:
-                        # Create new connection record
-                        new_connection = Connection(
-                            id=str(uuid.uuid4()),
-                            sharer_phone=user.phone,
-                            fly_instance=tunnel_info['instance_id'],
-                            status='active'
-                        )
-                        db.session.add(new_connection)
-                        user.sharing_active = True
-                        flash('Sharing started. Your bandwidth is now available in the NetShare pool.', 'success')
-                    else:
-                        flash(f'Failed to start sharing: {tunnel_info.get("error", "Unknown error")}', 'danger')
-                else:
-                    # Stop sharing - terminate all active connections
-                    active_connections = Connection.query.filter_by(
-                        sharer_phone=user.phone,
-                        status='active'
-                    ).all()
-
-                    for conn in active_connections:
-                        # Disconnect any clients using this connection
-                        if conn.client_phone:
-                            client = User.query.get(conn.client_phone)
-                            if client and client.connection_id == conn.id:
-                                client.connection_id = None
-
-                        # Terminate fly.io instance
-                        FlyNetworkManager.terminate_tunnel(conn.fly_instance)
-                        conn.status = 'terminated'
-
-                    user.sharing_active = False
-                    flash('Sharing stopped.', 'info')
-
-            db.session.commit()
-            flash('Settings updated', 'success')
 
         # Get current usage data
-        active_connections = Connection.query.filter_by(
-            sharer_phone=user.phone,
-            status='active'
-        ).all()
-
-        total_bandwidth = sum(conn.bandwidth_used for conn in active_connections)
-        connected_clients = sum(1 for conn in active_connections if conn.client_phone)
+        total_bandwidth, connected_clients = db.session.query(
+            func.coalesce(func.sum(Connection.bandwidth_used), 0.0),
+            func.count(Connection.client_phone)
+        ).filter_by(sharer_phone=user.phone, status='active').one()
+
+        # The client table and the Fly.io status both read these, including
+        # connections with no client attached yet; only the rendered columns load
+        active_connections = get_active_connections(
+            user.phone,
+            Connection.client_phone, Connection.created_at,
+            Connection.bandwidth_used, Connection.fly_instance
+        )
 
         return render_template(
             'sharer.html',
@@ -552,66 +716,143 @@ def dashboard():
             user=user,
             total_bandwidth=total_bandwidth,
             connected_clients=connected_clients,
-            active_connections=active_connections
+            active_connections=active_connections,
+            update_url=url_for('update_sharing')
         )
 
     elif role == 'client':
-        form = ClientForm()
-
-        # Check if client already has a connection
-        active_connection = None
-        if user.connection_id:
-            active_connection = Connection.query.get(user.connection_id)
-
-        if form.validate_on_submit():
-            if 'connect' in request.form:
-                # Find available sharers with capacity
-                available_sharers = User.query.filter_by(
-                    role='sharer',
-                    sharing_active=True
-                ).filter(
-                    User.shared_data < User.limit_gb
-                ).all()
-
-                if available_sharers:
-                    # Sort by least used capacity
-                    available_sharers.sort(key=lambda x: x.shared_data / x.limit_gb)
-                    best_sharer = available_sharers[0]
-
-                    # Connect to the best sharer
-                    connection_success = switch_connection(user.phone, best_sharer.phone)
-
-                    if connection_success:
-                        flash('Connected! Enjoy your NetShare bandwidth.', 'success')
-                        logger.info(f"Client {phone} connected to NetShare via sharer {best_sharer.phone}")
-                    else:
-                        flash('Failed to connect. Please try again.', 'danger')
-                else:
-                    flash('No available sharers found. Please try again later.', 'warning')
-
-            elif 'disconnect' in request.form and active_connection:
-                # Disconnect from current connection
-                active_connection.client_phone = None
-                user.connection_id = None
-                db.session.commit()
-                flash('Disconnected from NetShare.', 'info')
-
-        # Refresh connection status after form submission
-        if user.connection_id:
-            active_connection = Connection.query.get(user.connection_id)
-
         return render_template(
             'client.html',
-            form=form,
+            form=ClientForm(),
             phone=phone,
             user=user,
-            connection=active_connection
+            connection=active_connection,
+            connect_url=url_for('dashboard_connect'),
+            disconnect_url=url_for('dashboard_disconnect')
         )
 
     else:
         flash('Invalid user role', 'danger')
         return redirect(url_for('logout'))
 
+@app.route('/dashboard/update', methods=['POST'])
+@login_required
+def update_sharing():
+    """Save sharer settings and start/stop sharing"""
+    user = get_user(session.get('phone'))
+    if not user or user.role != 'sharer':
+        return redirect(url_for('dashboard'))
+
+    form = SharerForm()
+    if not form.validate_on_submit():
+        for errors in form.errors.values():
+            flash(errors[0], 'danger')
+        return redirect(url_for('dashboard'))
+
+    # Update user settings
+    user.limit_gb = form.limit_gb.data
+    stopped_instances = []
+
+    # Handle sharing toggle
+    if form.sharing.data != user.sharing_active:
+        if form.sharing.data:
+            # Start sharing
+            tunnel_info = FlyNetworkManager.create_tunnel(user.phone)
+            if tunnel_info['success']:
+                # Create new connection record
+                new_connection = Connection(
+                    sharer_phone=user.phone,
+                    fly_instance=tunnel_info['instance_id'],
+                    status='active'
+                )
+                db.session.add(new_connection)
+                user.sharing_active = True
+                flash('Sharing started. Your bandwidth is now available in the NetShare pool.', 'success')
+            else:
+                flash(f'Failed to start sharing: {tunnel_info.get("error", "Unknown error")}', 'danger')
+        else:
+            # Stop sharing - terminate all active connections
+            active_connections = db.session.execute(
+                select(Connection.id, Connection.fly_instance).where(
+                    Connection.sharer_phone == user.phone,
+                    Connection.status == 'active'
+                )
+            ).all()
+
+            if active_connections:
+                conn_ids = [conn.id for conn in active_connections]
+
+                # One UPDATE each for the connections and the clients using them
+                db.session.execute(
+                    update(Connection)
+                    .where(Connection.id.in_(conn_ids))
+                    .values(status='terminated', client_phone=None)
+                )
+                db.session.execute(
+                    update(User)
+                    .where(User.connection_id.in_(conn_ids))
+                    .values(connection_id=None)
+                )
+                stopped_instances = [conn.fly_instance for conn in active_connections]
+
+            user.sharing_active = False
+            flash('Sharing stopped.', 'info')
+
+    db.session.commit()
+    invalidate_available_networks()
+
+    # The connections are already terminated in the database, so the fly.io
+    # teardown happens in the background instead of delaying the response
+    if stopped_instances:
+        FlyNetworkManager.terminate_tunnels_async(stopped_instances)
+
+    flash('Settings updated', 'success')
+    return redirect(url_for('dashboard'))
+
+@app.route('/dashboard/connect', methods=['POST'])
+@login_required
+def dashboard_connect():
+    """Connect the logged-in client to the least used sharer"""
+    phone = session.get('phone')
+    user = get_user(phone)
+    if not user or user.role != 'client' or not ClientForm().validate_on_submit():
+        return redirect(url_for('dashboard'))
+
+    # Find the available sharer with the least used capacity
+    best_sharer = find_least_used_sharer()
+
+    if best_sharer:
+        # Connect to the best sharer
+        connection_success = switch_connection(user.phone, best_sharer.phone)
+
+        if connection_success:
+            flash('Connected! Enjoy your NetShare bandwidth.', 'success')
+            logger.info(f"Client {phone} connected to NetShare via sharer {best_sharer.phone}")
+        else:
+            flash('Failed to connect. Please try again.', 'danger')
+    else:
+        flash('No available sharers found. Please try again later.', 'warning')
+
+    return redirect(url_for('dashboard'))
+
+@app.route('/dashboard/disconnect', methods=['POST'])
+@login_required
+def dashboard_disconnect():
+    """Disconnect the logged-in client from its current connection"""
+    user = get_user(session.get('phone'))
+    if not user or user.role != 'client' or not ClientForm().validate_on_submit():
+        return redirect(url_for('dashboard'))
+
+    active_connection = db.session.get(Connection, user.connection_id) if user.connection_id else None
+    if active_connection:
+        # Disconnect from current connection
+        active_connection.client_phone = None
+        user.connection_id = None
+        db.session.commit()
+        flash('Disconnected from NetShare.', 'info')
+
+    return redirect(url_for('dashboard'))
+
 @app.route('/logout')
 def logout():
     phone = session.get('phone')
@@ -626,16 +867,19 @@ def logout():
 def connection_status():
     """API endpoint to get connection status"""
     phone = session.get('phone')
-    user = User.query.get(phone)
+    user = get_user(phone)
 
     if not user:
-        return jsonify({'error': 'User not found'}), 404
+        return ojson({'error': 'User not found'}, 404)
 
     if user.role == 'client':
         # Return client connection status
         connection = None
         if user.connection_id:
-            conn = Connection.query.get(user.connection_id)
+            conn = db.session.get(Connection, user.connection_id, options=[load_only(
+                Connection.sharer_phone, Connection.status,
+                Connection.bandwidth_used, Connection.fly_instance
+            )])
             if conn:
                 connection = {
                     'id': conn.id,
@@ -645,7 +889,7 @@ def connection_status():
                     'proxy_url': f"https://{conn.fly_instance}.fly.dev"
                 }
 
-        return jsonify({
+        return ojson({
             'role': 'client',
             'phone': user.phone,
             'connection': connection
@@ -653,20 +897,21 @@ def connection_status():
 
     elif user.role == 'sharer':
         # Return sharer connections
-        active_connections = Connection.query.filter_by(
-            sharer_phone=user.phone,
-            status='active'
-        ).all()
+        active_connections = get_active_connections(
+            user.phone,
+            Connection.client_phone, Connection.bandwidth_used,
+            Connection.created_at, Connection.last_active
+        )
 
         connections = [{
             'id': conn.id,
             'client_phone': conn.client_phone,
             'bandwidth_used': conn.bandwidth_used,
-            'created_at': conn.created_at.isoformat(),
-            'last_active': conn.last_active.isoformat()
+            'created_at': conn.created_at,
+            'last_active': conn.last_active
         } for conn in active_connections]
 
-        return jsonify({
+        return ojson({
             'role': 'sharer',
             'phone': user.phone,
             'sharing_active': user.sharing_active,
@@ -675,43 +920,47 @@ def connection_status():
             'connections': connections
         })
 
-    return jsonify({'error': 'Invalid user role'}), 400
+    return ojson({'error': 'Invalid user role'}, 400)
+
+# Every client sees the same list, so one query serves all polls for 5 seconds
+_networks_cache = TTLCache(maxsize=1, ttl=5)
+_networks_lock = threading.Lock()
+
+@cached(_networks_cache, lock=_networks_lock)
+def get_available_networks():
+    """Sharers with spare capacity, as returned by /api/network/available"""
+    return [{
+        'sharer_id': sharer_phone[-4:],  # Last 4 digits for privacy
+        'available_gb': available_gb,
+        'signal_quality': signal_quality
+    } for sharer_phone, available_gb, signal_quality in db.session.execute(AVAILABLE_NETWORKS)]
+
+def invalidate_available_networks():
+    """Drop the cached list after a sharer's capacity or sharing state changes"""
+    with _networks_lock:
+        _networks_cache.clear()
 
 @app.route('/api/network/available', methods=['GET'])
 @login_required
 def available_networks():
     """API endpoint to get available sharers"""
     phone = session.get('phone')
-    user = User.query.get(phone)
+    user = get_user(phone)
 
     if not user or user.role != 'client':
-        return jsonify({'error': 'Unauthorized'}), 403
-
-    # Find available sharers with capacity
-    available_sharers = User.query.filter_by(
-        role='sharer',
-        sharing_active=True
-    ).filter(
-        User.shared_data < User.limit_gb
-    ).all()
-
-    networks = [{
-        'sharer_id': sharer.phone[-4:],  # Last 4 digits for privacy
-        'available_gb': sharer.limit_gb - sharer.shared_data,
-        'signal_quality': 'good' if (sharer.limit_gb - sharer.shared_data) > 2 else 'fair'
-    } for sharer in available_sharers]
-
-    return jsonify({
-        'networks': networks
+        return ojson({'error': 'Unauthorized'}, 403)
+
+    return ojson({
+        'networks': get_available_networks()
     })
 
 @app.route('/connect', methods=['POST'])
 @login_required
 def connect_client():
     """Handle client connection with better selection logic"""
-    client = User.query.get(session['phone'])
+    client = get_user(session['phone'])
     if not client or client.role != 'client':
-        return jsonify({'error': 'Unauthorized'}), 403
+        return ojson({'error': 'Unauthorized'}, 403)
 
     # Get optimal sharer based on geolocation and speed
     optimal_sharer = find_optimal_sharer(client)
@@ -719,13 +968,13 @@ def connect_client():
     if optimal_sharer:
         success = switch_connection(client.phone, optimal_sharer.phone)
         if success:
-            return jsonify({
+            return ojson({
                 'status': 'connected',
                 'sharer': optimal_sharer.phone[-4:],
                 'proxy_config': get_proxy_config(client.connection_id)
             })
 
-    return jsonify({'error': 'No available sharers'}), 404
+    return ojson({'error': 'No available sharers'}, 404)
 # ======= Error Handlers =======
 @app.errorhandler(404)
 def page_not_found(e):
@@ -735,19 +984,80 @@ def page_not_found(e):
 def internal_server_error(e):
     return render_template('error.html', error='Internal server error'), 500
 
-# ======= Run App =======
-if __name__ == '__main__':
+# ======= Background Jobs =======
+# In production the jobs run once, in the separate scheduler process
+# (scheduler.py), rather than in every gunicorn worker
+scheduler = BackgroundScheduler(timezone='UTC')
+
+def register_jobs(sched):
+    """Add the periodic jobs to an APScheduler scheduler"""
+    # Catch up on any missed reset at startup, then run at midnight UTC
+    sched.add_job(reset_daily_usage, 'cron', hour=0, id='reset_daily_usage',
+                  next_run_time=datetime.utcnow())
+    sched.add_job(monitor_connections_once, 'interval', seconds=60,
+                  id='monitor_connections', max_instances=1, coalesce=True)
+    sched.add_job(refresh_connection_metrics, 'interval', seconds=300,
+                  id='refresh_connection_metrics', max_instances=1, coalesce=True)
+
+# Only the process holding this lock runs the jobs, e.g. one of the two
+# processes the debug reloader starts, or a second scheduler.py on the host
+SCHEDULER_LOCK_PATH = os.getenv('SCHEDULER_LOCK_PATH', '/tmp/netshare-scheduler.lock')
+_scheduler_lock_file = None
+
+def acquire_scheduler_lock():
+    """Take the scheduler file lock without blocking; True if this process got it"""
+    global _scheduler_lock_file
+    lock_file = open(SCHEDULER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Kept open so the lock is held until the process exits
+    _scheduler_lock_file = lock_file
+    return True
+
+def start_scheduler():
+    """Run the periodic jobs in this process (development server only)"""
+    if not acquire_scheduler_lock():
+        logger.info("Scheduler already running in another process")
+        return
+    register_jobs(scheduler)
+    scheduler.start()
+
+# ======= Schema =======
+def upgrade_schema():
+    """Create missing tables, then add the columns and indexes create_all skips"""
+    # create_all() never alters a table that already exists, so columns and
+    # indexes added to the models since a database was created go in here.
+    # Added columns are nullable; e.g. User.otp_secret is filled on next login
     with app.app_context():
         db.create_all()
+        inspector = inspect(db.engine)
+        preparer = db.engine.dialect.identifier_preparer
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in columns:
+                        conn.execute(text(
+                            f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+                            f"{preparer.format_column(column)} {column.type.compile(db.engine.dialect)}"
+                        ))
+                        logger.info(f"Added column {table.name}.{column.name}")
+
+                indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name not in indexes:
+                        index.create(conn)
+                        logger.info(f"Created index {index.name}")
 
-    # Start background tasks
-    reset_thread = threading.Thread(target=reset_daily_usage)
-    reset_thread.daemon = True
-    reset_thread.start()
+# ======= Run App =======
+if __name__ == '__main__':
+    upgrade_schema()
 
-    monitor_thread = threading.Thread(target=monitor_connections)
-    monitor_thread.daemon = True
-    monitor_thread.start()
+    # Start background tasks
+    start_scheduler()
 
     debug_mode = os.getenv('FLASK_ENV') != 'production'
     app.run(debug=debug_mode, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
\ No newline at end of file
@@ -1,20 +1,33 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, session, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
+from cachetools import TTLCache, cached
 from wtforms import StringField, SubmitField, BooleanField, IntegerField, ValidationError
 from wtforms.validators import DataRequired, NumberRange, Regexp
+import atexit
+import functools
+import itertools
 import logging
 import os
 import pyotp
+import redis
 import requests
 import json
+import orjson
+import secrets
 import socket
+import sys
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
 
+# datetime.UTC only exists from Python 3.11
+UTC = timezone.utc
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,8 +35,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serve jsonify responses through orjson, which also encodes datetimes"""
+    # Only response() is replaced: dumps/loads stay stock because the session
+    # serializer relies on them, e.g. the object_hook that untags flash messages
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC), mimetype=self.mimetype)
+
 # Create Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Load configuration
 class Config:
@@ -31,6 +55,27 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL',
         f'sqlite:///{os.path.join(os.path.dirname(os.path.abspath(__file__)), "netshare.db")}')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # CSRF tokens last for the whole session instead of being reissued hourly
+    WTF_CSRF_TIME_LIMIT = None
+    # Server-side sessions are used when this is set (see app.py)
+    REDIS_URL = os.getenv('REDIS_URL')
+    # Show the OTP on the verification page outside debug (no SMS gateway yet)
+    SHOW_OTP = os.getenv('SHOW_OTP', '').lower() in ('1', 'true', 'yes')
+    # Each gunicorn worker process has its own engine, so the pool is sized
+    # per process: one connection per request thread (GUNICORN_THREADS) plus a
+    # little overflow for background threads. The database sees up to
+    # workers * (pool_size + max_overflow) connections.
+    # SQLite keeps SQLAlchemy's default pool since it rejects these options.
+    # pool_pre_ping/pool_recycle replace connections dropped by NAT or server
+    # timeouts while the background threads sit idle between runs
+    SQLALCHEMY_ENGINE_OPTIONS = {} if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', os.getenv('GUNICORN_THREADS', 4))),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 2)),
+        'pool_pre_ping': True,
+        'pool_recycle': 1800
+    }
+    # Room in the compiled statement cache for every hot query shape (default 500)
+    SQLALCHEMY_ENGINE_OPTIONS['query_cache_size'] = 1200
 
 app.config.from_object(Config)
 
@@ -45,9 +90,14 @@ class User(db.Model):
     role = db.Column(db.String(10), nullable=False)
     limit_gb = db.Column(db.Integer, default=5)
     shared_data = db.Column(db.Float, default=0.0)  # Data shared today in GB
-    last_reset = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    # Timestamps default to the database clock
+    last_reset = db.Column(db.DateTime, default=db.func.now(), index=True)
     sharing_active = db.Column(db.Boolean, default=False)
-    connection_id = db.Column(db.String(36), nullable=True)  # UUID for active connection
+    connection_id = db.Column(db.String(36), nullable=True, index=True)  # UUID for active connection
+
+    __table_args__ = (
+        db.Index('ix_user_role_sharing', 'role', 'sharing_active'),
+    )
 
 class Connection(db.Model):
     __tablename__ = 'connection'
@@ -57,12 +107,17 @@ class Connection(db.Model):
     fly_instance = db.Column(db.String(50), nullable=False)  # fly.io instance ID
     status = db.Column(db.String(20), default="active")  # active, paused, terminated
     bandwidth_used = db.Column(db.Float, default=0.0)  # in GB
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
-    last_active = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    created_at = db.Column(db.DateTime, default=db.func.now())
+    last_active = db.Column(db.DateTime, default=db.func.now())
 
     # Relationship to sharer
     sharer = db.relationship('User', backref='connections')
 
+    __table_args__ = (
+        db.Index('ix_conn_sharer_status', 'sharer_phone', 'status'),
+        db.Index('ix_conn_status', 'status'),
+    )
+
 # ======= Forms =======
 
 class LoginForm(FlaskForm):
@@ -85,13 +140,17 @@ class SignupForm(FlaskForm):
     def validate_phone(self, field):
         # Using execute instead of direct get to avoid SQLAlchemy operational errors
         try:
-            user = db.session.execute(db.select(User).filter_by(phone=field.data)).scalar_one_or_none()
-            if user:
-                raise ValidationError("Phone number already registered.")
+            # EXISTS answers from the primary key index without loading the row
+            exists = db.session.execute(
+                db.select(db.select(User.phone).filter_by(phone=field.data).exists())
+            ).scalar()
         except Exception as e:
             logger.warning(f"Error validating phone: {str(e)}")
             # Validation will proceed without error - this way, the form can still submit
             # and database models can be created when needed
+            return
+        if exists:
+            raise ValidationError("Phone number already registered.")
 
 class SharerForm(FlaskForm):
     limit_gb = IntegerField('Max share per day (GB)', validators=[DataRequired(), NumberRange(min=1, max=100)])
@@ -105,45 +164,135 @@ class ClientForm(FlaskForm):
 # ======= Utils =======
 
 def login_required(f):
+    @functools.wraps(f)
     def decorated_function(*args, **kwargs):
         if 'phone' not in session:
             flash('Please log in first', 'warning')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
-    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+def api_login_required(f):
+    """login_required for JSON endpoints: a plain 401, no flash or redirect"""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'phone' not in session:
+            return jsonify({'error': 'Authentication required'}), 401
+        return f(*args, **kwargs)
     return decorated_function
 
 def get_user(phone):
-    """Safely get a user by phone number"""
+    """Safely get a user by phone number, cached on g for the rest of the request"""
+    users = g.setdefault('_users', {})
+    if phone in users:
+        return users[phone]
     try:
-        return db.session.execute(db.select(User).filter_by(phone=phone)).scalar_one_or_none()
+        user = db.session.execute(db.select(User).filter_by(phone=phone)).scalar_one_or_none()
     except Exception as e:
         logger.error(f"Error getting user: {str(e)}")
         return None
+    users[phone] = user
+    return user
+
+@functools.lru_cache(maxsize=1024)
+def get_totp(secret):
+    """Return a cached TOTP object for a base32 secret"""
+    return pyotp.TOTP(secret)
+
+# Shared by every worker process when configured, see the OTP store and port counter
+_redis = redis.Redis.from_url(Config.REDIS_URL, decode_responses=True) if Config.REDIS_URL else None
+
+# Pending OTP secrets stay server-side; the session only carries a random id.
+# They live in Redis so login and verify can land on different workers; the
+# in-process dict is only used without Redis
+OTP_TTL = 300
+_otp_secrets = {}
+_otp_lock = threading.Lock()
+
+def store_otp_secret(secret):
+    """Keep an OTP secret for OTP_TTL seconds and return the id to put in the session"""
+    otp_id = secrets.token_urlsafe(16)
+    if _redis is not None:
+        _redis.set(f'netshare:otp:{otp_id}', secret, ex=OTP_TTL)
+        return otp_id
+
+    now = time.monotonic()
+    with _otp_lock:
+        # Drop expired entries so abandoned logins don't accumulate
+        for key in [k for k, (_, expires) in _otp_secrets.items() if expires < now]:
+            del _otp_secrets[key]
+        _otp_secrets[otp_id] = (secret, now + OTP_TTL)
+    return otp_id
+
+def get_otp_secret(otp_id):
+    """Return the secret stored under otp_id, or None if unknown or expired"""
+    if not otp_id:
+        return None
+    if _redis is not None:
+        return _redis.get(f'netshare:otp:{otp_id}')
 
-def reset_daily_usage():
-    """Reset daily data usage for all users if last_reset was yesterday"""
-    while True:
-        try:
-            with app.app_context():
-                today = datetime.now(UTC).date()
+    with _otp_lock:
+        entry = _otp_secrets.get(otp_id)
+    if not entry or entry[1] < time.monotonic():
+        return None
+    return entry[0]
 
-                # Use more robust querying
-                users = db.session.execute(
-                    db.select(User).where(User.last_reset < today)
-                ).scalars().all()
+def discard_otp_secret(otp_id):
+    if _redis is not None:
+        _redis.delete(f'netshare:otp:{otp_id}')
+        return
 
-                for user in users:
-                    user.shared_data = 0.0
-                    user.last_reset = datetime.now(UTC)
+    with _otp_lock:
+        _otp_secrets.pop(otp_id, None)
 
-                db.session.commit()
-                logger.info(f"Reset daily usage for {len(users)} users")
-        except Exception as e:
-            logger.error(f"Error in reset_daily_usage: {str(e)}")
+def find_best_sharer():
+    """Return the available sharer with the least used capacity, or None"""
+    return db.session.execute(
+        db.select(User).filter_by(
+            role='sharer',
+            sharing_active=True
+        ).where(User.shared_data < User.limit_gb)
+        .order_by((User.shared_data / User.limit_gb).asc())
+        .limit(1)
+    ).scalar_one_or_none()
 
-        # Sleep for 1 hour before next check
-        time.sleep(3600)
+def reset_daily_usage():
+    """Reset daily data usage for all users if last_reset was yesterday"""
+    try:
+        with app.app_context():
+            now = datetime.now(UTC)
+            # Compare against a datetime rather than a date so the range can
+            # use the last_reset index; stored timestamps are naive UTC
+            midnight = datetime.combine(now.date(), datetime.min.time())
+
+            # One UPDATE for all stale users, nothing loaded into the session
+            result = db.session.execute(
+                db.update(User)
+                .where(User.last_reset < midnight)
+                .values(shared_data=0.0, last_reset=now)
+                .execution_options(synchronize_session=False)
+            )
+
+            db.session.commit()
+            logger.info(f"Reset daily usage for {result.rowcount} users")
+    except Exception as e:
+        logger.error(f"Error in reset_daily_usage: {str(e)}")
+
+# Tunnel ports are handed out in turn from 5000-5999. Redis makes the counter
+# shared by every process; without it each process counts on its own
+TUNNEL_PORT_BASE = 5000
+TUNNEL_PORT_RANGE = 1000
+_port_counter = itertools.count()
+_port_lock = threading.Lock()
+
+def allocate_tunnel_port():
+    """Return the next port in the tunnel range"""
+    if _redis is not None:
+        n = _redis.incr('netshare:tunnel_port')
+    else:
+        with _port_lock:
+            n = next(_port_counter)
+    return TUNNEL_PORT_BASE + n % TUNNEL_PORT_RANGE
 
 # Fly.io integration utilities
 
@@ -178,7 +327,7 @@ class FlyNetworkManager:
                 'success': True,
                 'instance_id': instance_name,
                 'proxy_url': f"https://{instance_name}.fly.dev",
-                'tunnel_port': 5000 + hash(user_id) % 1000  # Simulate a port assignment
+                'tunnel_port': allocate_tunnel_port()
             }
         except Exception as e:
             logger.error(f"Error creating fly.io tunnel: {str(e)}")
@@ -221,53 +370,41 @@ class FlyNetworkManager:
             logger.error(f"Error fetching active tunnels: {str(e)}")
             return {'success': False, 'error': str(e)}
 
+# Shared pool for fly.io calls that can run side by side
+_fly_executor = ThreadPoolExecutor(max_workers=8)
+
 # Background task to monitor network stability and switch connections if needed
 
 def monitor_connections():
     """Monitor active connections and switch to more stable ones if needed"""
-    while True:
-        try:
-            with app.app_context():
-                # Get all active client connections
-                clients = db.session.execute(
-                    db.select(User).filter_by(role='client')
-                ).scalars().all()
-
-                for client in clients:
-                    # If client has a connection_id, check its stability
-                    if client.connection_id:
-                        connection = db.session.execute(
-                            db.select(Connection).filter_by(id=client.connection_id)
-                        ).scalar_one_or_none()
-
-                        if connection:
-                            # Check if connection is still active and stable
-                            # In a real implementation, this would involve ping tests, bandwidth checks, etc.
-                            if connection.status != 'active' or (datetime.now(UTC) - connection.last_active).total_seconds() > 300:
-                                # Connection unstable, find a better one
-                                logger.info(f"Connection {connection.id} unstable for client {client.phone}, finding alternative")
-
-                                # Find available sharers with capacity
-                                available_sharers = db.session.execute(
-                                    db.select(User).filter_by(
-                                        role='sharer',
-                                        sharing_active=True
-                                    ).where(User.shared_data < User.limit_gb)
-                                ).scalars().all()
-
-                                if available_sharers:
-                                    # Sort by least used capacity
-                                    available_sharers.sort(key=lambda x: x.shared_data / x.limit_gb)
-                                    best_sharer = available_sharers[0]
-
-                                    # Create new connection
-                                    switch_connection(client.phone, best_sharer.phone)
-                                    logger.info(f"Switched client {client.phone} to sharer {best_sharer.phone}")
-        except Exception as e:
-            logger.error(f"Error in connection monitor: {str(e)}")
-
-        # Sleep for 1 minute before next check
-        time.sleep(60)
+    try:
+        with app.app_context():
+            # Get every client together with its connection in one query
+            client_connections = db.session.execute(
+                db.select(User, Connection)
+                .join(Connection, User.connection_id == Connection.id)
+                .where(User.role == 'client')
+            ).all()
+
+            # The replacement sharer is picked once per pass
+            best_sharer = find_best_sharer()
+
+            # Stored timestamps come back naive, so compare against naive UTC
+            stale_before = datetime.now(UTC).replace(tzinfo=None) - timedelta(seconds=300)
+
+            for client, connection in client_connections:
+                # Check if connection is still active and stable
+                # In a real implementation, this would involve ping tests, bandwidth checks, etc.
+                if connection.status != 'active' or connection.last_active < stale_before:
+                    # Connection unstable, find a better one
+                    logger.info(f"Connection {connection.id} unstable for client {client.phone}, finding alternative")
+
+                    if best_sharer:
+                        # Create new connection
+                        switch_connection(client.phone, best_sharer.phone)
+                        logger.info(f"Switched client {client.phone} to sharer {best_sharer.phone}")
+    except Exception as e:
+        logger.error(f"Error in connection monitor: {str(e)}")
 
 def switch_connection(client_phone, sharer_phone):
     """Switch a client's connection to a new sharer"""
@@ -277,6 +414,8 @@ def switch_connection(client_phone, sharer_phone):
     if not client or not sharer:
         return False
 
+    now = datetime.now(UTC)
+
     # If client has existing connection, update it
     if client.connection_id:
         old_connection = db.session.execute(
@@ -309,13 +448,12 @@ def switch_connection(client_phone, sharer_phone):
             client_phone=client.phone,
             fly_instance=tunnel_info['instance_id'],
             status='active',
-            created_at=datetime.now(UTC),
-            last_active=datetime.now(UTC)
+            created_at=now,
+            last_active=now
         )
         db.session.add(new_connection)
-        db.session.commit()
 
-        # Update client's connection ID
+        # Update client's connection ID; one commit covers the whole switch
         client.connection_id = new_connection.id
         db.session.commit()
         logger.info(f"Client {client.phone} connected to sharer {sharer.phone} via {tunnel_info['proxy_url']}")
@@ -323,15 +461,39 @@ def switch_connection(client_phone, sharer_phone):
     else:
         # Reuse existing sharer connection if it's active
         active_connection = sharer_connections[0]
+        # The row is already being updated, so last_active goes in the same UPDATE
         active_connection.client_phone = client.phone
-        active_connection.last_active = datetime.now(UTC)
-        db.session.commit()
+        active_connection.last_active = now
 
         client.connection_id = active_connection.id
         db.session.commit()
         logger.info(f"Client {client.phone} reconnected to existing sharer connection {active_connection.id}")
         return True
 
+# ======= Background Jobs =======
+
+# Set on interpreter exit so the job loop stops without waiting out its interval
+_shutdown = threading.Event()
+atexit.register(_shutdown.set)
+
+BACKGROUND_JOBS = (
+    (reset_daily_usage, 3600),
+    (monitor_connections, 60),
+)
+
+def run_background_jobs():
+    """Run every periodic job from this one thread, each whenever it falls due"""
+    next_run = [0.0] * len(BACKGROUND_JOBS)
+    while True:
+        for i, (job, interval) in enumerate(BACKGROUND_JOBS):
+            if time.monotonic() >= next_run[i]:
+                job()
+                next_run[i] = time.monotonic() + interval
+
+        # Wait until the next job is due, or stop on shutdown
+        if _shutdown.wait(max(0.0, min(next_run) - time.monotonic())):
+            break
+
 # ======= Routes =======
 
 @app.route('/signup', methods=['GET', 'POST'])
@@ -363,12 +525,11 @@ def login():
         phone = form.phone.data
         user = get_user(phone)
         if user:
-            secret = session.get('otp_secret')
+            secret = get_otp_secret(session.get('otp_id'))
             if not secret:
                 secret = pyotp.random_base32()
-                session['otp_secret'] = secret
-            totp = pyotp.TOTP(secret)
-            otp = totp.now()
+                session['otp_id'] = store_otp_secret(secret)
+            otp = get_totp(secret).now()
             session['phone_tmp'] = phone
             # In production, send the OTP via SMS
             print(f"OTP for {phone}: {otp}")
@@ -382,13 +543,14 @@ def verify_otp():
     form = OTPForm()
     if form.validate_on_submit():
         otp = form.otp.data
-        secret = session.get('otp_secret')
+        otp_id = session.get('otp_id')
+        secret = get_otp_secret(otp_id)
         phone = session.get('phone_tmp')
-        totp = pyotp.TOTP(secret)
 
-        if totp.verify(otp, valid_window=1):  # allows +/- 30 seconds (1 window)
+        if secret and get_totp(secret).verify(otp, valid_window=1):  # allows +/- 30 seconds (1 window)
             session['phone'] = phone  # Set the phone in the session
-            session.pop('otp_secret', None)
+            discard_otp_secret(otp_id)
+            session.pop('otp_id', None)
             session.pop('phone_tmp', None)
             flash('OTP verified. Logged in.', 'success')
             logger.info(f"OTP verified for {phone}. Redirecting to dashboard.")
@@ -432,37 +594,47 @@ def dashboard():
                         )
                         db.session.add(new_connection)
                         user.sharing_active = True
-                        db.session.commit()
                         flash('Sharing started. Your bandwidth is now available in the NetShare pool.', 'success')
                     else:
                         flash(f'Failed to start sharing: {tunnel_info.get("error", "Unknown error")}', 'danger')
                 else:
                     # Stop sharing - terminate all active connections
                     active_connections = db.session.execute(
-                        db.select(Connection).filter_by(
+                        db.select(Connection.id, Connection.fly_instance).filter_by(
                             sharer_phone=user.phone,
                             status='active'
                         )
-                    ).scalars().all()
-
-                    for conn in active_connections:
-                        # Disconnect any clients using this connection
-                        if conn.client_phone:
-                            client = get_user(conn.client_phone)
-                            if client and client.connection_id == conn.id:
-                                client.connection_id = None
-
-                        # Terminate fly.io instance
-                        FlyNetworkManager.terminate_tunnel(conn.fly_instance)
-                        conn.status = 'terminated'
+                    ).all()
+
+                    if active_connections:
+                        conn_ids = [conn.id for conn in active_connections]
+
+                        # Terminate the fly.io instances concurrently
+                        list(_fly_executor.map(
+                            FlyNetworkManager.terminate_tunnel,
+                            [conn.fly_instance for conn in active_connections]
+                        ))
+
+                        # Disconnect any clients using these connections
+                        db.session.execute(
+                            db.update(User)
+                            .where(User.connection_id.in_(conn_ids))
+                            .values(connection_id=None)
+                        )
+                        db.session.execute(
+                            db.update(Connection)
+                            .where(Connection.id.in_(conn_ids))
+                            .values(status='terminated')
+                        )
 
                     user.sharing_active = False
-                    db.session.commit()
                     flash('Sharing stopped.', 'info')
             else:
-                db.session.commit()
                 flash('Settings updated', 'success')
 
+            # Single commit for the settings change and any sharing toggle
+            db.session.commit()
+
         # Get current usage data
         active_connections = db.session.execute(
             db.select(Connection).filter_by(
@@ -471,8 +643,13 @@ def dashboard():
             )
         ).scalars().all()
 
-        total_bandwidth = sum(conn.bandwidth_used for conn in active_connections)
-        connected_clients = sum(1 for conn in active_connections if conn.client_phone)
+        # Totals are aggregated by the database rather than summed over rows
+        total_bandwidth, connected_clients = db.session.execute(
+            db.select(
+                db.func.coalesce(db.func.sum(Connection.bandwidth_used), 0),
+                db.func.count(Connection.client_phone)
+            ).where(Connection.sharer_phone == user.phone, Connection.status == 'active')
+        ).one()
 
         return render_template(
             'sharer.html',
@@ -496,19 +673,10 @@ def dashboard():
 
         if form.validate_on_submit():
             if 'connect' in request.form:
-                # Find available sharers with capacity
-                available_sharers = db.session.execute(
-                    db.select(User).filter_by(
-                        role='sharer',
-                        sharing_active=True
-                    ).where(User.shared_data < User.limit_gb)
-                ).scalars().all()
-
-                if available_sharers:
-                    # Sort by least used capacity
-                    available_sharers.sort(key=lambda x: x.shared_data / x.limit_gb)
-                    best_sharer = available_sharers[0]
+                # Find the available sharer with the least used capacity
+                best_sharer = find_best_sharer()
 
+                if best_sharer:
                     # Connect to the best sharer
                     connection_success = switch_connection(user.phone, best_sharer.phone)
 
@@ -527,11 +695,12 @@ def dashboard():
                 db.session.commit()
                 flash('Disconnected from NetShare.', 'info')
 
-        # Refresh connection status after form submission
-        if user.connection_id:
-            active_connection = db.session.execute(
-                db.select(Connection).filter_by(id=user.connection_id)
-            ).scalar_one_or_none()
+            # Refresh connection status after form submission
+            active_connection = None
+            if user.connection_id:
+                active_connection = db.session.execute(
+                    db.select(Connection).filter_by(id=user.connection_id)
+                ).scalar_one_or_none()
 
         return render_template(
             'client.html',
@@ -555,7 +724,7 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/api/connections/status', methods=['GET'])
-@login_required
+@api_login_required
 def connection_status():
     """API endpoint to get connection status"""
     phone = session.get('phone')
@@ -569,8 +738,14 @@ def connection_status():
         connection = None
         if user.connection_id:
             conn = db.session.execute(
-                db.select(Connection).filter_by(id=user.connection_id)
-            ).scalar_one_or_none()
+                db.select(
+                    Connection.id,
+                    Connection.sharer_phone,
+                    Connection.status,
+                    Connection.bandwidth_used,
+                    Connection.fly_instance
+                ).filter_by(id=user.connection_id)
+            ).one_or_none()
 
             if conn:
                 connection = {
@@ -589,20 +764,21 @@ def connection_status():
 
     elif user.role == 'sharer':
         # Return sharer connections
+        # Only the columns in the payload, as plain rows
         active_connections = db.session.execute(
-            db.select(Connection).filter_by(
+            db.select(
+                Connection.id,
+                Connection.client_phone,
+                Connection.bandwidth_used,
+                Connection.created_at,
+                Connection.last_active
+            ).filter_by(
                 sharer_phone=user.phone,
                 status='active'
             )
-        ).scalars().all()
+        ).all()
 
-        connections = [{
-            'id': conn.id,
-            'client_phone': conn.client_phone,
-            'bandwidth_used': conn.bandwidth_used,
-            'created_at': conn.created_at.isoformat(),
-            'last_active': conn.last_active.isoformat()
-        } for conn in active_connections]
+        connections = [row._asdict() for row in active_connections]
 
         return jsonify({
             'role': 'sharer',
@@ -615,23 +791,16 @@ def connection_status():
 
     return jsonify({'error': 'Invalid user role'}), 400
 
-@app.route('/api/network/available', methods=['GET'])
-@login_required
-def available_networks():
-    """API endpoint to get available sharers"""
-    phone = session.get('phone')
-    user = get_user(phone)
-
-    if not user or user.role != 'client':
-        return jsonify({'error': 'Unauthorized'}), 403
-
+@cached(TTLCache(maxsize=1, ttl=5), lock=threading.Lock())
+def get_available_networks():
+    """Sharers with spare capacity; shared by all clients for 5 seconds"""
     # Find available sharers with capacity
     available_sharers = db.session.execute(
-        db.select(User).filter_by(
+        db.select(User.phone, User.limit_gb, User.shared_data).filter_by(
             role='sharer',
             sharing_active=True
         ).where(User.shared_data < User.limit_gb)
-    ).scalars().all()
+    ).all()
 
     networks = [{
         'sharer_id': sharer.phone[-4:],  # Last 4 digits for privacy
@@ -639,6 +808,20 @@ def available_networks():
         'signal_quality': 'good' if (sharer.limit_gb - sharer.shared_data) > 2 else 'fair'
     } for sharer in available_sharers]
 
+    return networks
+
+@app.route('/api/network/available', methods=['GET'])
+@api_login_required
+def available_networks():
+    """API endpoint to get available sharers"""
+    phone = session.get('phone')
+    user = get_user(phone)
+
+    if not user or user.role != 'client':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    networks = get_available_networks()
+
     return jsonify({
         'networks': networks
     })
@@ -654,13 +837,13 @@ def internal_server_error(e):
     return render_template('error.html', error='Internal server error'), 500
 
 # ======= Initialize Database =======
-def init_db():
-    """Initialize the database and create tables"""
+def init_db(reset=False, verify=False):
+    """Create any missing tables; optionally wipe the SQLite file first and verify the schema"""
     with app.app_context():
         try:
             # Get database path from config
             db_uri = app.config['SQLALCHEMY_DATABASE_URI']
-            if db_uri.startswith('sqlite:///'):
+            if reset and db_uri.startswith('sqlite:///'):
                 # Extract path from SQLite URI
                 db_path = db_uri.replace('sqlite:///', '')
                 # If path is relative, make it absolute
@@ -671,9 +854,12 @@ def init_db():
                     os.remove(db_path)
                     logger.info(f"Removed existing database: {db_path}")
 
-            # Create all tables fresh
+            # Only creates what is missing, so this is a no-op on an existing database
             db.create_all()
 
+            if not verify:
+                return
+
             # Add verification step to make sure tables created properly
             inspector = db.inspect(db.engine)
             table_names = inspector.get_table_names()
@@ -710,14 +896,14 @@ def init_db():
 # ======= Run App =======
 if __name__ == '__main__':
     # Initialize the database before running the app
-    init_db()
-
-    # Start background tasks as daemon threads
-    reset_thread = threading.Thread(target=reset_daily_usage, daemon=True)
-    reset_thread.start()
-
-    monitor_thread = threading.Thread(target=monitor_connections, daemon=True)
-    monitor_thread.start()
+    init_db(
+        reset=bool(os.getenv('NETSHARE_RESET_DB')),
+        verify='--verify-schema' in sys.argv
+    )
+
+    # All background jobs share one daemon thread running an event loop
+    jobs_thread = threading.Thread(target=run_background_jobs, daemon=True)
+    jobs_thread.start()
 
     # Run the Flask application
     debug_mode = os.getenv('FLASK_ENV') != 'production'
@@ -61,6 +61,10 @@ pip install --upgrade pip
 pip install -r requirements.txt
 pip install gunicorn # Add gunicorn for production
 
+# Bring an existing database up to date (new tables, columns and indexes)
+print_message "Upgrading database schema..."
+python -c "from app import upgrade_schema; upgrade_schema()"
+
 # 4. Create production .env file if it doesn't exist
 if [ ! -f ".env" ]; then
   print_message "Creating production .env file..."
@@ -81,7 +85,7 @@ print_message "Configuring Supervisor..."
 cat > /etc/supervisor/conf.d/netshare.conf << EOF
 [program:netshare]
 directory=$APP_DIR
-command=$APP_DIR/venv/bin/gunicorn -w 4 -b 127.0.0.1:8000 app:app
+command=$APP_DIR/venv/bin/gunicorn -c gunicorn.conf.py -b 127.0.0.1:8000 wsgi:app
 user=$APP_USER
 autostart=true
 autorestart=true
@@ -89,6 +93,17 @@ stopasgroup=true
 killasgroup=true
 stdout_logfile=/var/log/netshare/gunicorn.log
 stderr_logfile=/var/log/netshare/gunicorn.error.log
+
+[program:netshare-scheduler]
+directory=$APP_DIR
+command=$APP_DIR/venv/bin/python scheduler.py
+user=$APP_USER
+autostart=true
+autorestart=true
+stopasgroup=true
+killasgroup=true
+stdout_logfile=/var/log/netshare/scheduler.log
+stderr_logfile=/var/log/netshare/scheduler.error.log
 EOF
 
 # Create log directory
@@ -0,0 +1,12 @@
+# Gunicorn settings for NetShare
+# Handlers block on fly.io, ping and speedtest calls, so threaded workers keep
+# other requests moving. Every worker process opens its own SQLAlchemy pool,
+# which config.Config sizes from GUNICORN_THREADS, so the database sees about
+# workers * threads connections.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = 30
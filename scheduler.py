@@ -0,0 +1,22 @@
+"""Periodic job runner, deployed as its own process: python scheduler.py
+
+Keeps the daily reset, connection monitor and metric refresh out of the web
+workers so each job runs exactly once however many workers gunicorn starts.
+"""
+import sys
+
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from app import acquire_scheduler_lock, logger, register_jobs, upgrade_schema
+
+if __name__ == '__main__':
+    if not acquire_scheduler_lock():
+        logger.error("Another scheduler holds the lock, exiting")
+        sys.exit(1)
+
+    upgrade_schema()
+
+    scheduler = BlockingScheduler(timezone='UTC')
+    register_jobs(scheduler)
+    logger.info("Starting scheduler")
+    scheduler.start()
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
+import atexit
 import os
 import time
 import logging
+import secrets
 import sqlite3
 import requests
 import uuid
 import string
-import random
 import subprocess
 import tempfile
+import threading
 from string import Template
 
 # Setup logging
@@ -18,29 +20,58 @@ logger = logging.getLogger(__name__)
 # Database connection
 DB_URL = os.getenv('DATABASE_URL', 'netshare.db')
 
+# Statements run on every call; kept as constants so each connection's statement cache reuses them
+_SQL_ACTIVE_PORTS = 'SELECT port FROM connections WHERE status = "active"'
+_SQL_INSERT_CONNECTION = (
+    'INSERT INTO connections (id, sharer_phone, fly_instance, status, port, username, password) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?)'
+)
+_SQL_TERMINATE_CONNECTION = 'UPDATE connections SET status = "terminated" WHERE id = ?'
+# RETURNING needs SQLite 3.35+
+_SQL_TERMINATE_RETURNING_CLIENT = _SQL_TERMINATE_CONNECTION + ' RETURNING client_phone'
+_SQL_DETACH_CLIENT = 'UPDATE users SET connection_id = NULL WHERE phone = ?'
+_SQL_STALE_CONNECTIONS = (
+    'SELECT c.id, c.client_phone FROM connections c JOIN users u ON c.sharer_phone = u.phone '
+    'WHERE c.status = "active" AND NOT COALESCE(u.sharing_active, 0)'
+)
+
+# One connection per thread, opened on first use and kept for the life of the thread
+_tls = threading.local()
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_URL)
+    conn = getattr(_tls, 'conn', None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(DB_URL, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # WAL lets the monitor's writes run alongside readers; wait on locks instead of failing
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA cache_size=-32000')
+    _tls.conn = conn
+    # Other threads' connections go with their thread-local storage; closing
+    # one from the exiting main thread would fail the same-thread check
+    if threading.current_thread() is threading.main_thread():
+        atexit.register(conn.close)
     return conn
 
 def generate_credentials():
     """Generate random username and password for FRP SOCKS5 proxy"""
-    username = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-    password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    # secrets draws from the OS CSPRNG; random's Mersenne Twister is predictable
+    username = ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+    password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(12))
     return username, password
 
 def assign_port():
     """Assign an available port for the FRP tunnel"""
-    # Start from 9000 and find the next available port
+    # Lowest port from 9000 up that no active connection holds
     conn = get_db_connection()
-    used_ports = [row['port'] for row in conn.execute('SELECT port FROM connections WHERE status = "active"')]
-    conn.close()
+    used_ports = {row['port'] for row in conn.execute(_SQL_ACTIVE_PORTS)}
 
-    port = 9000
-    while port in used_ports and port < 10000:
-        port += 1
-
-    if port >= 10000:
+    port = next((p for p in range(9000, 10000) if p not in used_ports), None)
+    if port is None:
         raise Exception("No ports available in the allowed range")
 
     return port
@@ -56,15 +87,14 @@ def create_tunnel(sharer_phone):
         conn = get_db_connection()
         connection_id = str(uuid.uuid4())
 
-        # Insert new connection
-        conn.execute(
-            'INSERT INTO connections (id, sharer_phone, fly_instance, status, port, username, password) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (connection_id, sharer_phone, f"netshare-{sharer_phone[-4:]}", "active", port, username, password)
-        )
-        conn.commit()
-        conn.close()
+        # Insert new connection; the with block commits, or rolls back on error
+        with conn:
+            conn.execute(
+                _SQL_INSERT_CONNECTION,
+                (connection_id, sharer_phone, f"netshare-{sharer_phone[-4:]}", "active", port, username, password)
+            )
 
-        logger.info(f"Created tunnel for {sharer_phone} on port {port}")
+        logger.info("Created tunnel for %s on port %s", sharer_phone, port)
         return {
             'success': True,
             'connection_id': connection_id,
@@ -73,27 +103,23 @@ def create_tunnel(sharer_phone):
             'password': password
         }
     except Exception as e:
-        logger.error(f"Failed to create tunnel: {str(e)}")
+        logger.error("Failed to create tunnel: %s", e)
         return {'success': False, 'error': str(e)}
 
 def terminate_tunnel(connection_id):
     """Terminate an active tunnel"""
     try:
         conn = get_db_connection()
-        conn.execute('UPDATE connections SET status = "terminated" WHERE id = ?', (connection_id,))
-        conn.commit()
-
-        # Get the details to update the client if necessary
-        connection = conn.execute('SELECT client_phone FROM connections WHERE id = ?', (connection_id,)).fetchone()
-        if connection and connection['client_phone']:
-            conn.execute('UPDATE users SET connection_id = NULL WHERE phone = ?', (connection['client_phone'],))
-            conn.commit()
+        # Terminate and detach the client in one transaction
+        with conn:
+            connection = conn.execute(_SQL_TERMINATE_RETURNING_CLIENT, (connection_id,)).fetchone()
+            if connection and connection['client_phone']:
+                conn.execute(_SQL_DETACH_CLIENT, (connection['client_phone'],))
 
-        conn.close()
-        logger.info(f"Terminated tunnel {connection_id}")
+        logger.info("Terminated tunnel %s", connection_id)
         return {'success': True}
     except Exception as e:
-        logger.error(f"Failed to terminate tunnel: {str(e)}")
+        logger.error("Failed to terminate tunnel: %s", e)
         return {'success': False, 'error': str(e)}
 
 def monitor_connections():
@@ -102,23 +128,26 @@ def monitor_connections():
         try:
             conn = get_db_connection()
 
-            # Get active connections
-            active_connections = conn.execute(
-                'SELECT c.id, c.sharer_phone, c.port, c.username, c.password, '
-                'u.sharing_active FROM connections c JOIN users u ON c.sharer_phone = u.phone '
-                'WHERE c.status = "active"'
-            ).fetchall()
+            # Active connections whose sharer has disabled sharing
+            stale_connections = conn.execute(_SQL_STALE_CONNECTIONS).fetchall()
 
-            for connection in active_connections:
-                # If sharer has disabled sharing, terminate the connection
-                if not connection['sharing_active']:
-                    terminate_tunnel(connection['id'])
-                    logger.info(f"Terminated tunnel {connection['id']} due to sharing disabled")
+            if stale_connections:
+                # Terminate them all and detach their clients in a single transaction
+                with conn:
+                    conn.executemany(
+                        _SQL_TERMINATE_CONNECTION,
+                        [(row['id'],) for row in stale_connections]
+                    )
+                    conn.executemany(
+                        _SQL_DETACH_CLIENT,
+                        [(row['client_phone'],) for row in stale_connections if row['client_phone']]
+                    )
 
-            conn.close()
+                for row in stale_connections:
+                    logger.info("Terminated tunnel %s due to sharing disabled", row['id'])
 
         except Exception as e:
-            logger.error(f"Error in connection monitor: {str(e)}")
+            logger.error("Error in connection monitor: %s", e)
 
         # Sleep for 60 seconds before next check
         time.sleep(60)
@@ -128,22 +157,24 @@ if __name__ == "__main__":
 
     # Create necessary database tables if they don't exist
     conn = get_db_connection()
-    conn.execute('''
-    CREATE TABLE IF NOT EXISTS connections (
-        id TEXT PRIMARY KEY,
-        sharer_phone TEXT,
-        client_phone TEXT,
-        fly_instance TEXT,
-        status TEXT,
-        port INTEGER,
-        username TEXT,
-        password TEXT,
-        bandwidth_used REAL DEFAULT 0.0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS connections (
+            id TEXT PRIMARY KEY,
+            sharer_phone TEXT,
+            client_phone TEXT,
+            fly_instance TEXT,
+            status TEXT,
+            port INTEGER,
+            username TEXT,
+            password TEXT,
+            bandwidth_used REAL DEFAULT 0.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        # assign_port and the monitor only ever look at active rows
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conn_status_port ON connections (status, port)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conn_sharer_status ON connections (sharer_phone, status)')
 
     # Start monitoring connections
     monitor_connections()
\ No newline at end of file